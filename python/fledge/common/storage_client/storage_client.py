@@ -13,6 +13,7 @@ __license__ = "Apache 2.0"
 __version__ = "${VERSION}"
 
 import aiohttp
+import asyncio
 import http.client
 import json
 import time
@@ -289,6 +290,46 @@ class StorageClientAsync(AbstractStorage):
                     "value" : "SENT_test"
             }
         """
+        self._verify_query_with_payload(tbl_name, query_payload)
+
+        async with aiohttp.ClientSession() as session:
+            jdoc = await self._put_query_with_payload(session, tbl_name, query_payload)
+
+        return jdoc
+
+    async def query_tbl_with_payload_batch(self, queries):
+        """ Complex SELECT queries issued concurrently over a single client session
+
+        :param queries: list of (tbl_name, query_payload) tuples, each payload in valid JSON format
+        :return: list of results in the same order as queries
+
+        :Example:
+            count_result, rows_result = await query_tbl_with_payload_batch([('log', count_payload),
+                                                                            ('log', rows_payload)])
+        """
+        for tbl_name, query_payload in queries:
+            self._verify_query_with_payload(tbl_name, query_payload)
+
+        async with aiohttp.ClientSession() as session:
+            tasks = [asyncio.ensure_future(self._put_query_with_payload(session, tbl_name, query_payload))
+                     for tbl_name, query_payload in queries]
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                for task in tasks:
+                    if task in done and task.exception() is not None:
+                        raise task.exception()
+                results = [task.result() for task in tasks]
+            finally:
+                # Cancel the queries still in flight when one has failed, before the session is closed under them
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        return results
+
+    @staticmethod
+    def _verify_query_with_payload(tbl_name, query_payload):
         if not tbl_name:
             raise ValueError("Table name is missing")
 
@@ -298,18 +339,18 @@ class StorageClientAsync(AbstractStorage):
         if not Utils.is_json(query_payload):
             raise TypeError("Query payload must be a valid JSON")
 
+    async def _put_query_with_payload(self, session, tbl_name, query_payload):
         put_url = '/storage/table/{tbl_name}/query'.format(tbl_name=tbl_name)
 
         url = 'http://' + self.base_url + put_url
 
-        async with aiohttp.ClientSession() as session:
-            async with session.put(url, data=query_payload) as resp:
-                status_code = resp.status
-                jdoc = await resp.json()
-                if status_code not in range(200, 209):
-                    _LOGGER.info("PUT %s, with query payload: %s", put_url, query_payload)
-                    _LOGGER.error("Error code: %d, reason: %s, details: %s", resp.status, resp.reason, jdoc)
-                    raise StorageServerError(code=resp.status, reason=resp.reason, error=jdoc)
+        async with session.put(url, data=query_payload) as resp:
+            status_code = resp.status
+            jdoc = await resp.json()
+            if status_code not in range(200, 209):
+                _LOGGER.info("PUT %s, with query payload: %s", put_url, query_payload)
+                _LOGGER.error("Error code: %d, reason: %s, details: %s", resp.status, resp.reason, jdoc)
+                raise StorageServerError(code=resp.status, reason=resp.reason, error=jdoc)
 
         return jdoc
 
@@ -4,15 +4,21 @@
 # See: http://fledge-iot.readthedocs.io/
 # FLEDGE_END
 
-import copy
+import time
 from datetime import datetime
 from enum import IntEnum
+from functools import lru_cache
 from aiohttp import web
 import json
 
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, fall back to the standard json module
+    orjson = None
+
 from fledge.common.audit_logger import AuditLogger
 from fledge.common.logger import FLCoreLogger
-from fledge.common.storage_client.payload_builder import PayloadBuilder
 from fledge.common.storage_client.exceptions import StorageServerError
 from fledge.services.core import connect
 
@@ -23,6 +29,14 @@ __version__ = "${VERSION}"
 
 __DEFAULT_LIMIT = 20
 __DEFAULT_OFFSET = 0
+_LOG_CODES_CACHE_TTL = 60
+""" Seconds for which the set of valid log codes is served from cache """
+
+_log_codes_cache = {"codes": None, "ts": 0.0}
+
+_AUDIT_RETURN_COLUMNS = ["code", "level", "log",
+                         {"column": "ts", "format": "YYYY-MM-DD HH24:MI:SS.MS", "alias": "timestamp"}]
+""" Columns returned for audit entries, ts formatted and aliased as timestamp """
 
 _help = """
     -------------------------------------------------------------------------------
@@ -43,11 +57,73 @@ class Severity(IntEnum):
     WARNING = 2
     INFORMATION = 4
 
+
+_SEVERITY_NAMES = {_severity.value: _severity.name for _severity in Severity}
+""" Severity names keyed by log.level """
+
+_SEVERITY_BY_NAME = {_severity.name: _severity.value for _severity in Severity}
+""" log.level values keyed by severity name """
+
+_SEVERITY_JSON_BYTES = json.dumps(
+    {"logSeverity": [{'index': _severity.value, 'name': _severity.name} for _severity in Severity]}).encode()
+""" Response body of GET /fledge/audit/severity, constant as Severity is immutable """
+
+_SEVERITY_DISPATCH = {
+    "success": AuditLogger.success,
+    "failure": AuditLogger.failure,
+    "warning": AuditLogger.warning,
+    "information": AuditLogger.information
+}
+""" AuditLogger coroutine methods keyed by lowercase severity """
+
 ####################################
 #  Audit Trail
 ####################################
 
 
+def _json_response(data):
+    """ Same as web.json_response, but encoded with orjson when it is installed and able to encode data
+
+    Note: orjson writes NaN and Infinity as null, where the json module writes them as NaN and Infinity
+    """
+    if orjson is not None:
+        try:
+            return web.Response(body=orjson.dumps(data), content_type='application/json', charset='utf-8')
+        except TypeError:
+            # orjson.JSONEncodeError, e.g. for integers beyond 64-bit range which the json module does encode
+            pass
+    return web.json_response(data)
+
+
+async def _get_log_codes(storage_client, ttl=_LOG_CODES_CACHE_TTL):
+    """ Returns the set of valid log codes, refreshed from storage once the cached set is older than ttl seconds """
+    if _log_codes_cache["codes"] is None or time.monotonic() - _log_codes_cache["ts"] > ttl:
+        # SELECT * FROM log_codes
+        result = await storage_client.query_tbl("log_codes")
+        _set_log_codes_cache(result['rows'])
+    return _log_codes_cache["codes"]
+
+
+def _set_log_codes_cache(rows):
+    """ Refreshes the cached set of valid log codes from the rows of the log_codes table """
+    _log_codes_cache["codes"] = frozenset(row['code'] for row in rows)
+    _log_codes_cache["ts"] = time.monotonic()
+
+
+def _invalidate_log_codes_cache():
+    """ Drops the cached log codes, the next source validation reads them again from storage """
+    _log_codes_cache["codes"] = None
+    _log_codes_cache["ts"] = 0.0
+
+
+async def _validate_source(storage_client, source_list):
+    """ Raises ValueError for the first code in source_list which is not a valid log code """
+    log_codes = await _get_log_codes(storage_client)
+    for code in source_list:
+        if code not in log_codes:
+            raise ValueError(code)
+
+
 async def create_audit_entry(request):
     """ Creates a new Audit entry
 
@@ -79,47 +155,38 @@ async def create_audit_entry(request):
                         }
         }
     """
-    return_error = False
-    err_msg = "Missing required parameter"
-
     payload = await request.json()
 
     severity = payload.get("severity")
     source = payload.get("source")
     details = payload.get("details")
 
-    if severity is None or severity == "":
-        err_msg += " severity"
-        return_error = True
-    if source is None or source == "":
-        err_msg += " source"
-        return_error = True
+    missing = [param for param, value in (("severity", severity), ("source", source)) if value is None or value == ""]
     if details is None:
-        err_msg += " details"
-        return_error = True
-
-    if return_error:
-        raise web.HTTPBadRequest(reason=err_msg)
+        missing.append("details")
+    if missing:
+        raise web.HTTPBadRequest(reason="Missing required parameter(s): " + ", ".join(missing))
 
     if not isinstance(details, dict):
         raise web.HTTPBadRequest(reason="Details should be a valid json object")
 
+    log_entry = _SEVERITY_DISPATCH.get(str(severity).lower())
+    if log_entry is None:
+        err_msg = "severity type {} is not supported".format(severity)
+        raise web.HTTPBadRequest(reason=err_msg, body=json.dumps({"message": err_msg}))
+
     try:
         audit = AuditLogger()
-        await getattr(audit, str(severity).lower())(source, details)
+        await log_entry(audit, source, details)
 
         # Set timestamp for return message
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        timestamp = datetime.now().isoformat(sep=' ', timespec='milliseconds')
 
-        message = {'timestamp': str(timestamp),
+        message = {'timestamp': timestamp,
                    'source': source,
                    'severity': severity,
                    'details': details
                    }
-    except AttributeError as e:
-        # Return error for wrong severity method
-        err_msg = "severity type {} is not supported".format(severity)
-        raise web.HTTPNotFound(reason=err_msg, body=json.dumps({"message": err_msg}))
     except StorageServerError as ex:
         if int(ex.code) in range(400, 500):
             err_msg = 'Audit entry cannot be logged. {}'.format(ex.error['message'])
@@ -133,7 +200,43 @@ async def create_audit_entry(request):
         _logger.error(ex, "Failed to log audit entry.")
         raise web.HTTPInternalServerError(reason=msg, body=json.dumps({"message": msg}))
     else:
-        return web.json_response(message)
+        return _json_response(message)
+
+
+@lru_cache(maxsize=128)
+def _get_query_payloads(source, severity, limit, offset):
+    """ Returns the count and rows query payloads for the given audit filters as JSON strings, rows payload is None
+    for limit 0
+
+    Cached as dashboards keep polling with the same filters
+    """
+    source_list = source.split(',') if source is not None else []
+    if len(source_list) > 1:
+        where = {'column': 'code', 'condition': 'in', 'value': source_list}
+        innermost_where = where
+    else:
+        where = {'column': '1', 'condition': '=', 'value': 1}
+        innermost_where = where
+        if source is not None:
+            innermost_where = {'column': 'code', 'condition': '=', 'value': source}
+            where['and'] = innermost_where
+    if severity is not None:
+        innermost_where['and'] = {'column': 'level', 'condition': '=', 'value': severity}
+
+    # SELECT *, count(*) OVER() FROM log - No support yet from storage layer
+    # TODO: FOGL-740, FOGL-663 once ^^ resolved we should replace below storage call for getting total rows
+    total_count_payload = json.dumps({'aggregate': {'operation': 'count', 'column': '*', 'alias': 'count'},
+                                      'where': where})
+
+    rows_payload = None
+    if limit > 0:
+        rows = {'return': _AUDIT_RETURN_COLUMNS, 'where': where,
+                'sort': {'column': 'ts', 'direction': 'desc'}, 'limit': limit}
+        if offset > 0:
+            rows['skip'] = offset
+        rows_payload = json.dumps(rows)
+
+    return total_count_payload, rows_payload
 
 
 async def get_audit_entries(request):
@@ -159,20 +262,29 @@ async def get_audit_entries(request):
 
         curl -X GET "http://localhost:8081/fledge/audit?source=CONAD&since=2022-10-10%2009:31:32"
     """
+    try:
+        storage_client = connect.get_storage_async()
+    except Exception as ex:
+        msg = str(ex)
+        _logger.error(ex, "Failed to get Audit log entry.")
+        raise web.HTTPInternalServerError(reason=msg, body=json.dumps({"message": msg}))
 
+    query = request.query
     limit = __DEFAULT_LIMIT
-    if 'limit' in request.query and request.query['limit'] != '':
+    limit_param = query.get('limit')
+    if limit_param:
         try:
-            limit = int(request.query['limit'])
+            limit = int(limit_param)
             if limit < 0:
                 raise ValueError
         except ValueError:
             raise web.HTTPBadRequest(reason="Limit must be a positive integer")
 
     offset = __DEFAULT_OFFSET
-    if 'skip' in request.query and request.query['skip'] != '':
+    skip_param = query.get('skip')
+    if skip_param:
         try:
-            offset = int(request.query['skip'])
+            offset = int(skip_param)
             if offset < 0:
                 raise ValueError
         except ValueError:
@@ -180,100 +292,62 @@ async def get_audit_entries(request):
 
     # If microsend is required then add .%f into the __DATE_FORMAT & remove the split from datetime string conversion
     __DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
-    if 'since' in request.query and request.query['since'] != '':
+    since = query.get('since')
+    if since:
         try:
-            datetime.strptime(request.query['since'], __DATE_FORMAT)
+            datetime.strptime(since, __DATE_FORMAT)
         except ValueError:
             msg = "Incorrect date format, should be {}".format(__DATE_FORMAT)
             raise web.HTTPBadRequest(reason=msg, body=json.dumps({"message": msg}))
 
-    source = None
-    source_list = []
-    if 'source' in request.query and request.query['source'] != '':
+    source = query.get('source') or None
+    if source is not None:
         try:
-            source = request.query.get('source')
-            source_list = source.split(',')
-            # SELECT * FROM log_codes
-            storage_client = connect.get_storage_async()
-            result = await storage_client.query_tbl("log_codes")
-            log_codes = [key['code'] for key in result['rows']]
-            for code in source_list:
-                if code not in log_codes:
-                    raise ValueError(code)
+            await _validate_source(storage_client, source.split(','))
         except ValueError as e:
             raise web.HTTPBadRequest(reason="{} is not a valid source".format(str(e)))
 
     severity = None
-    if 'severity' in request.query and request.query['severity'] != '':
-        try:
-            severity = Severity[request.query['severity'].upper()].value
-        except KeyError as ex:
-            raise web.HTTPBadRequest(reason="{} is not a valid severity".format(ex))
+    severity_param = query.get('severity')
+    if severity_param:
+        severity_name = severity_param.upper()
+        severity = _SEVERITY_BY_NAME.get(severity_name)
+        if severity is None:
+            raise web.HTTPBadRequest(reason="'{}' is not a valid severity".format(severity_name))
 
     try:
-        # HACK: This way when we can more future we do not get an exponential
-        # explosion of if statements
-        payload = PayloadBuilder().SELECT("code", "level", "log", "ts")\
-            .ALIAS("return", ("ts", 'timestamp')).FORMAT("return", ("ts", "YYYY-MM-DD HH24:MI:SS.MS"))\
-            .WHERE(['1', '=', 1])
+        total_count_payload, rows_payload = _get_query_payloads(source, severity, limit, offset)
 
-        if source is not None:
-            if len(source_list) == 1:
-                payload.AND_WHERE(['code', '=', source])
-            else:
-                payload = PayloadBuilder().SELECT("code", "level", "log", "ts") \
-                    .ALIAS("return", ("ts", 'timestamp')).FORMAT("return", ("ts", "YYYY-MM-DD HH24:MI:SS.MS"))
-                payload.WHERE(['code', 'in', source_list])
-        if severity is not None:
-            payload.AND_WHERE(['level', '=', severity])
-
-        _and_where_payload = payload.chain_payload()
-        # SELECT *, count(*) OVER() FROM log - No support yet from storage layer
-        # TODO: FOGL-740, FOGL-663 once ^^ resolved we should replace below storage call for getting total rows
-        _and_where_copy = copy.deepcopy(_and_where_payload)
-        total_count_payload = PayloadBuilder(_and_where_copy).AGGREGATE(["count", "*"])\
-            .ALIAS("aggregate", ("*", "count", "count")).payload()
-
-        # SELECT count (*) FROM log <_and_where_payload>
-        storage_client = connect.get_storage_async()
-        result = await storage_client.query_tbl_with_payload('log', total_count_payload)
+        if limit == 0:
+            # Only the total count is wanted, SELECT count (*) FROM log <where>
+            result = await storage_client.query_tbl_with_payload('log', total_count_payload)
+            rows = []
+        else:
+            # SELECT count (*) FROM log <where> and SELECT * FROM log <rows_payload>, concurrently
+            result, results = await storage_client.query_tbl_with_payload_batch(
+                [('log', total_count_payload), ('log', rows_payload)])
+            rows = results['rows']
         total_count = result['rows'][0]['count']
-
-        payload = PayloadBuilder(_and_where_payload)
-        payload.ORDER_BY(['ts', 'desc'])
-        payload.LIMIT(limit)
-
-        if offset > 0:
-            payload.OFFSET(offset)
-
-        # SELECT * FROM log <payload.payload()>
-        results = await storage_client.query_tbl_with_payload('log', payload.payload())
-        rows = results['rows']
         # If 'since' datetime string param is passed then filter the records internally from the actual storage result
-        if 'since' in request.query:
-            since_dt = datetime.strptime(request.query['since'].split('.', 1)[0], __DATE_FORMAT)
+        if since:
+            since_dt = datetime.strptime(since.split('.', 1)[0], __DATE_FORMAT)
             temp_rows = []
-            for row in results["rows"]:
+            for row in rows:
                 convert_dt = datetime.strptime(row['timestamp'].split('.', 1)[0], __DATE_FORMAT)
                 if since_dt <= convert_dt:
                     temp_rows.append(row)
             rows = temp_rows
             total_count = len(rows)
-        res = []
-        for row in rows:
-            r = dict()
-            r["details"] = row["log"]
-            severity_level = int(row["level"])
-            r["severity"] = Severity(severity_level).name if severity_level in (0, 1, 2, 4) else "UNKNOWN"
-            r["source"] = row["code"]
-            r["timestamp"] = row["timestamp"]
-            res.append(r)
+        res = [{"details": row["log"],
+                "severity": _SEVERITY_NAMES.get(int(row["level"]), "UNKNOWN"),
+                "source": row["code"],
+                "timestamp": row["timestamp"]} for row in rows]
     except Exception as ex:
         msg = str(ex)
         _logger.error(ex, "Failed to get Audit log entry.")
         raise web.HTTPInternalServerError(reason=msg, body=json.dumps({"message": msg}))
     else:
-        return web.json_response({'audit': res, 'totalCount': total_count})
+        return _json_response({'audit': res, 'totalCount': total_count})
 
 
 async def get_audit_log_codes(request):
@@ -290,8 +364,9 @@ async def get_audit_log_codes(request):
     """
     storage_client = connect.get_storage_async()
     result = await storage_client.query_tbl('log_codes')
+    _set_log_codes_cache(result['rows'])
 
-    return web.json_response({'logCode': result['rows']})
+    return _json_response({'logCode': result['rows']})
 
 
 async def get_audit_log_severity(request):
@@ -306,9 +381,4 @@ async def get_audit_log_severity(request):
 
         curl -X GET http://localhost:8081/fledge/audit/severity
     """
-    results = []
-    for _severity in Severity:
-        data = {'index': _severity.value, 'name': _severity.name}
-        results.append(data)
-
-    return web.json_response({"logSeverity": results})
+    return web.Response(body=_SEVERITY_JSON_BYTES, content_type='application/json', charset='utf-8')
@@ -64,6 +64,9 @@ class FakeFledgeStorageSrvr:
     async def query_with_payload_insert_into_or_update_tbl_handler(self, request):
         payload = await request.json()
 
+        if payload.get("delay", None):
+            await asyncio.sleep(payload["delay"])
+
         if payload.get("bad_request", None):
             return web.HTTPBadRequest(reason="bad data", text='{"key": "value"}')
 
@@ -492,6 +495,57 @@ class TestStorageClientAsync:
 
         await fake_storage_srvr.stop()
 
+    @pytest.mark.asyncio
+    async def test_query_tbl_with_payload_batch(self, event_loop):
+        # 'PUT', '/storage/table/{tbl_name}/query', query_payload for each of the batched queries
+
+        fake_storage_srvr = FakeFledgeStorageSrvr(loop=event_loop)
+        await fake_storage_srvr.start()
+
+        mockServiceRecord = MagicMock(ServiceRecord)
+        mockServiceRecord._address = HOST
+        mockServiceRecord._type = "Storage"
+        mockServiceRecord._port = PORT
+        mockServiceRecord._management_port = 2000
+
+        sc = StorageClientAsync(1, 2, mockServiceRecord)
+        assert "{}:{}".format(HOST, PORT) == sc.base_url
+
+        with pytest.raises(Exception) as excinfo:
+            await sc.query_tbl_with_payload_batch([("aTable", json.dumps({"k": "v"})), (None, json.dumps({"k": "v"}))])
+        assert excinfo.type is ValueError
+        assert "Table name is missing" in str(excinfo.value)
+
+        with pytest.raises(Exception) as excinfo:
+            await sc.query_tbl_with_payload_batch([("aTable", {"k": "v"})])
+        assert excinfo.type is TypeError
+        assert "Query payload must be a valid JSON" in str(excinfo.value)
+
+        response = await sc.query_tbl_with_payload_batch([("aTable", json.dumps({"k1": "v1"})),
+                                                          ("bTable", json.dumps({"k2": "v2"}))])
+        assert [{"called": {"k1": "v1"}}, {"called": {"k2": "v2"}}] == response
+
+        with pytest.raises(Exception) as excinfo:
+            with patch.object(_LOGGER, "error") as log_e:
+                with patch.object(_LOGGER, "info") as log_i:
+                    await sc.query_tbl_with_payload_batch([("aTable", json.dumps({"k": "v"})),
+                                                           ("aTable", json.dumps({"bad_request": "v"}))])
+            log_i.assert_called_once_with("PUT %s, with query payload: %s", '/storage/table/aTable/query',
+                                          '{"bad_request": "v"}')
+            log_e.assert_called_once_with("Error code: %d, reason: %s, details: %s", 400, 'bad data', {'key': 'value'})
+        assert excinfo.type is aiohttp.client_exceptions.ContentTypeError
+
+        # A failing query cancels the queries of the batch which are still in flight
+        with pytest.raises(Exception) as excinfo:
+            await sc.query_tbl_with_payload_batch([("aTable", json.dumps({"delay": 1})),
+                                                   ("aTable", json.dumps({"bad_request": "v"}))])
+        assert excinfo.type is aiohttp.client_exceptions.ContentTypeError
+        in_flight = [task for task in asyncio.all_tasks()
+                     if '_put_query_with_payload' in getattr(task.get_coro(), '__qualname__', '')]
+        assert [] == in_flight
+
+        await fake_storage_srvr.stop()
+
 
 @pytest.allure.feature("unit")
 @pytest.allure.story("common", "storage_client")
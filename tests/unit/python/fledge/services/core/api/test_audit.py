@@ -36,6 +36,12 @@ class TestAudit:
         routes.setup(app)
         return loop.run_until_complete(test_client(app))
 
+    @pytest.fixture(autouse=True)
+    def clear_log_codes_cache(self):
+        audit._invalidate_log_codes_cache()
+        yield
+        audit._invalidate_log_codes_cache()
+
     @pytest.fixture()
     def get_log_codes(self):
         return {"rows": [{"code": "PURGE", "description": "Data Purging Process"},
@@ -58,9 +64,48 @@ class TestAudit:
                          {"code": "BKEXC", "description": "Backup Complete"}
                          ]}
 
+    def test_json_response_with_orjson(self):
+        orjson_mock = MagicMock()
+        orjson_mock.dumps.return_value = b'{"audit":[],"totalCount":0}'
+        with patch.object(audit, 'orjson', orjson_mock):
+            resp = audit._json_response({'audit': [], 'totalCount': 0})
+        orjson_mock.dumps.assert_called_once_with({'audit': [], 'totalCount': 0})
+        assert 'application/json' == resp.content_type
+        assert 'utf-8' == resp.charset
+        assert b'{"audit":[],"totalCount":0}' == resp.body
+
+    def test_json_response_with_real_orjson(self):
+        orjson = pytest.importorskip("orjson")
+        data = {'audit': [{'details': {'message': 'Engine oil pressure low'}, 'severity': 'WARNING',
+                           'source': 'LMTR', 'timestamp': '2018-03-05 07:36:52.823'}], 'totalCount': 1}
+        with patch.object(audit, 'orjson', orjson):
+            resp = audit._json_response(data)
+            expected = web.json_response(data)
+        assert orjson.dumps(data) == resp.body
+        assert data == json.loads(resp.text)
+        assert expected.headers['Content-Type'] == resp.headers['Content-Type']
+
+    def test_json_response_without_orjson(self):
+        with patch.object(audit, 'orjson', None):
+            resp = audit._json_response({'audit': [], 'totalCount': 0})
+        assert 'application/json' == resp.content_type
+        assert 'utf-8' == resp.charset
+        assert {'audit': [], 'totalCount': 0} == json.loads(resp.text)
+
+    def test_json_response_orjson_encode_error(self):
+        data = {'details': {'x': 2 ** 70}}
+        orjson_mock = MagicMock()
+        orjson_mock.dumps.side_effect = TypeError("Integer exceeds 64-bit range")
+        with patch.object(audit, 'orjson', orjson_mock):
+            resp = audit._json_response(data)
+        orjson_mock.dumps.assert_called_once_with(data)
+        assert 'application/json' == resp.content_type
+        assert data == json.loads(resp.text)
+
     async def test_get_severity(self, client):
         resp = await client.get('/fledge/audit/severity')
         assert 200 == resp.status
+        assert 'application/json; charset=utf-8' == resp.headers['Content-Type']
         result = await resp.text()
         json_response = json.loads(result)
         log_severity = json_response['logSeverity']
@@ -112,7 +157,10 @@ class TestAudit:
         ('?severity=failure', {'where': {'and': {'value': 1, 'column': 'level', 'condition': '='}, 'value': 1, 'column': '1', 'condition': '='}, 'limit': 20, 'return': ['code', 'level', 'log', {'column': 'ts', 'format': 'YYYY-MM-DD HH24:MI:SS.MS', 'alias': 'timestamp'}], 'sort': {'direction': 'desc', 'column': 'ts'}}),
         ('?severity=FAILURE&limit=1', {'limit': 1, 'sort': {'direction': 'desc', 'column': 'ts'}, 'return': ['code', 'level', 'log', {'column': 'ts', 'format': 'YYYY-MM-DD HH24:MI:SS.MS', 'alias': 'timestamp'}], 'where': {'value': 1, 'condition': '=', 'and': {'value': 1, 'condition': '=', 'column': 'level'}, 'column': '1'}}),
         ('?severity=INFORMATION&limit=1&skip=1', {'limit': 1, 'sort': {'direction': 'desc', 'column': 'ts'}, 'return': ['code', 'level', 'log', {'column': 'ts', 'format': 'YYYY-MM-DD HH24:MI:SS.MS', 'alias': 'timestamp'}], 'skip': 1, 'where': {'value': 1, 'condition': '=', 'and': {'value': 4, 'condition': '=', 'column': 'level'}, 'column': '1'}}),
-        ('?source=&severity=&limit=&skip=', {'limit': 20, 'sort': {'direction': 'desc', 'column': 'ts'}, 'return': ['code', 'level', 'log', {'column': 'ts', 'format': 'YYYY-MM-DD HH24:MI:SS.MS', 'alias': 'timestamp'}], 'where': {'value': 1, 'condition': '=', 'column': '1'}})
+        ('?source=PURGE&severity=success', {'return': ['code', 'level', 'log', {'column': 'ts', 'format': 'YYYY-MM-DD HH24:MI:SS.MS', 'alias': 'timestamp'}], 'where': {'column': '1', 'condition': '=', 'value': 1, 'and': {'column': 'code', 'condition': '=', 'value': 'PURGE', 'and': {'column': 'level', 'condition': '=', 'value': 0}}}, 'sort': {'column': 'ts', 'direction': 'desc'}, 'limit': 20}),
+        ('?source=PURGE,START&severity=warning', {'return': ['code', 'level', 'log', {'column': 'ts', 'format': 'YYYY-MM-DD HH24:MI:SS.MS', 'alias': 'timestamp'}], 'where': {'column': 'code', 'condition': 'in', 'value': ['PURGE', 'START'], 'and': {'column': 'level', 'condition': '=', 'value': 2}}, 'sort': {'column': 'ts', 'direction': 'desc'}, 'limit': 20}),
+        ('?source=&severity=&limit=&skip=', {'limit': 20, 'sort': {'direction': 'desc', 'column': 'ts'}, 'return': ['code', 'level', 'log', {'column': 'ts', 'format': 'YYYY-MM-DD HH24:MI:SS.MS', 'alias': 'timestamp'}], 'where': {'value': 1, 'condition': '=', 'column': '1'}}),
+        ('?since=', {'limit': 20, 'sort': {'direction': 'desc', 'column': 'ts'}, 'return': ['code', 'level', 'log', {'column': 'ts', 'format': 'YYYY-MM-DD HH24:MI:SS.MS', 'alias': 'timestamp'}], 'where': {'value': 1, 'condition': '=', 'column': '1'}})
     ])
     async def test_get_audit_with_params(self, client, request_params, payload, get_log_codes, loop):
         storage_client_mock = MagicMock(StorageClientAsync)
@@ -123,7 +171,7 @@ class TestAudit:
                               "timestamp": "2018-01-30 18:39:48.796263", 'count': 1}]}
         
         async def async_mock():
-            return response
+            return [response, response]
 
         async def async_mock_log():
             return get_log_codes
@@ -138,17 +186,98 @@ class TestAudit:
         
         with patch.object(connect, 'get_storage_async', return_value=storage_client_mock):
             with patch.object(storage_client_mock, 'query_tbl', return_value=_rv1):
-                with patch.object(storage_client_mock, 'query_tbl_with_payload', return_value=_rv2) as log_code_patch:
+                with patch.object(storage_client_mock, 'query_tbl_with_payload_batch',
+                                  return_value=_rv2) as query_patch:
                     resp = await client.get('/fledge/audit{}'.format(request_params))
                     assert 200 == resp.status
                     result = await resp.text()
                     json_response = json.loads(result)
                     assert 1 == json_response['totalCount']
                     assert 1 == len(json_response['audit'])
-                args, kwargs = log_code_patch.call_args
-                assert 'log' == args[0]
-                p = json.loads(args[1])
-                assert payload == p
+                args, kwargs = query_patch.call_args
+                (count_tbl, count_payload), (tbl, rows_payload) = args[0]
+                assert 'log' == count_tbl
+                assert 'log' == tbl
+                assert {"aggregate": {"operation": "count", "column": "*", "alias": "count"},
+                        "where": payload['where']} == json.loads(count_payload)
+                assert payload == json.loads(rows_payload)
+
+    async def test_get_audit_count_only(self, client):
+        storage_client_mock = MagicMock(StorageClientAsync)
+        response = {"rows": [{"count": 42}]}
+
+        async def async_mock():
+            return response
+
+        # Changed in version 3.8: patch() now returns an AsyncMock if the target is an async function.
+        if sys.version_info.major == 3 and sys.version_info.minor >= 8:
+            _rv = await async_mock()
+        else:
+            _rv = asyncio.ensure_future(async_mock())
+
+        with patch.object(connect, 'get_storage_async', return_value=storage_client_mock):
+            with patch.object(storage_client_mock, 'query_tbl_with_payload', return_value=_rv) as query_patch:
+                with patch.object(storage_client_mock, 'query_tbl_with_payload_batch') as batch_patch:
+                    resp = await client.get('/fledge/audit?limit=0&severity=warning')
+                    assert 200 == resp.status
+                    result = await resp.text()
+                    json_response = json.loads(result)
+                    assert {'audit': [], 'totalCount': 42} == json_response
+                batch_patch.assert_not_called()
+            args, kwargs = query_patch.call_args
+            assert 'log' == args[0]
+            assert {"aggregate": {"operation": "count", "column": "*", "alias": "count"},
+                    "where": {"column": "1", "condition": "=", "value": 1,
+                              "and": {"column": "level", "condition": "=", "value": 2}}} == json.loads(args[1])
+
+    @pytest.mark.parametrize("level, severity", [
+        ("0", "SUCCESS"),
+        ("1", "FAILURE"),
+        ("2", "WARNING"),
+        ("3", "UNKNOWN"),
+        ("4", "INFORMATION"),
+        ("5", "UNKNOWN")
+    ])
+    async def test_get_audit_severity_name(self, client, level, severity):
+        storage_client_mock = MagicMock(StorageClientAsync)
+        response = {"rows": [{"log": {"message": "Engine oil pressure low"}, "code": "LMTR", "level": level, "id": 1,
+                              "timestamp": "2018-01-30 18:39:48.796263", 'count': 1}]}
+
+        async def async_mock():
+            return [response, response]
+
+        # Changed in version 3.8: patch() now returns an AsyncMock if the target is an async function.
+        if sys.version_info.major == 3 and sys.version_info.minor >= 8:
+            _rv = await async_mock()
+        else:
+            _rv = asyncio.ensure_future(async_mock())
+
+        with patch.object(connect, 'get_storage_async', return_value=storage_client_mock):
+            with patch.object(storage_client_mock, 'query_tbl_with_payload_batch', return_value=_rv):
+                resp = await client.get('/fledge/audit')
+                assert 200 == resp.status
+                result = await resp.text()
+                json_response = json.loads(result)
+                assert [{"details": {"message": "Engine oil pressure low"}, "severity": severity, "source": "LMTR",
+                         "timestamp": "2018-01-30 18:39:48.796263"}] == json_response['audit']
+
+    def test_query_payloads_are_cached(self):
+        payloads = audit._get_query_payloads('PURGE', 2, 10, 5)
+        count_payload, rows_payload = payloads
+        assert isinstance(count_payload, str)
+        assert isinstance(rows_payload, str)
+        where = {'column': '1', 'condition': '=', 'value': 1,
+                 'and': {'column': 'code', 'condition': '=', 'value': 'PURGE',
+                         'and': {'column': 'level', 'condition': '=', 'value': 2}}}
+        assert {'aggregate': {'operation': 'count', 'column': '*', 'alias': 'count'},
+                'where': where} == json.loads(count_payload)
+        rows = json.loads(rows_payload)
+        assert where == rows['where']
+        assert 10 == rows['limit']
+        assert 5 == rows['skip']
+        assert payloads is audit._get_query_payloads('PURGE', 2, 10, 5)
+        assert 6 == json.loads(audit._get_query_payloads('PURGE', 2, 10, 6)[1])['skip']
+        assert audit._get_query_payloads('PURGE', 2, 0, 0)[1] is None
 
     @pytest.mark.parametrize("request_params, response_code, response_message", [
         ('?source=BLA', 400, "BLA is not a valid source"),
@@ -177,6 +306,59 @@ class TestAudit:
                 assert response_code == resp.status
                 assert response_message == resp.reason
 
+    async def test_log_codes_are_cached(self, client, get_log_codes):
+        async def async_mock_log():
+            return get_log_codes
+
+        # Changed in version 3.8: patch() now returns an AsyncMock if the target is an async function.
+        if sys.version_info.major == 3 and sys.version_info.minor >= 8:
+            _rv = await async_mock_log()
+        else:
+            _rv = asyncio.ensure_future(async_mock_log())
+
+        storage_client_mock = MagicMock(StorageClientAsync)
+        with patch.object(connect, 'get_storage_async', return_value=storage_client_mock):
+            with patch.object(storage_client_mock, 'query_tbl', return_value=_rv) as log_code_patch:
+                resp = await client.get('/fledge/audit?source=BLA')
+                assert 400 == resp.status
+                assert "BLA is not a valid source" == resp.reason
+                resp = await client.get('/fledge/audit?source=NTF')
+                assert 400 == resp.status
+                assert "NTF is not a valid source" == resp.reason
+            log_code_patch.assert_called_once_with('log_codes')
+
+    async def test_log_codes_cache_refresh(self, client, get_log_codes):
+        new_codes = {"rows": get_log_codes["rows"] + [{"code": "NEWCD", "description": "New Code"}]}
+
+        async def async_mock_log():
+            return get_log_codes
+
+        async def async_mock_new_log():
+            return new_codes
+
+        # Changed in version 3.8: patch() now returns an AsyncMock if the target is an async function.
+        if sys.version_info.major == 3 and sys.version_info.minor >= 8:
+            _rv1 = await async_mock_log()
+            _rv2 = await async_mock_new_log()
+        else:
+            _rv1 = asyncio.ensure_future(async_mock_log())
+            _rv2 = asyncio.ensure_future(async_mock_new_log())
+
+        storage_client_mock = MagicMock(StorageClientAsync)
+        with patch.object(connect, 'get_storage_async', return_value=storage_client_mock):
+            with patch.object(storage_client_mock, 'query_tbl', return_value=_rv1):
+                resp = await client.get('/fledge/audit?source=NEWCD')
+                assert 400 == resp.status
+                assert "NEWCD is not a valid source" == resp.reason
+            # Listing the log codes refreshes the cache with any code added since
+            with patch.object(storage_client_mock, 'query_tbl', return_value=_rv2) as log_code_patch:
+                resp = await client.get('/fledge/audit/logcode')
+                assert 200 == resp.status
+                assert frozenset(row['code'] for row in new_codes['rows']) == audit._log_codes_cache["codes"]
+            log_code_patch.assert_called_once_with('log_codes')
+        audit._invalidate_log_codes_cache()
+        assert audit._log_codes_cache["codes"] is None
+
     async def test_get_audit_http_exception(self, client):
         msg = 'Internal Server Error'
         with patch.object(connect, 'get_storage_async', side_effect=Exception(msg)):
@@ -213,11 +395,12 @@ class TestAudit:
             assert 'timestamp' in json_response
 
     @pytest.mark.parametrize("request_data, expected_response", [
-        ({"source": "LMTR", "severity": "", "details": {"message": "Engine oil pressure low"}}, "Missing required parameter severity"),
-        ({"source": "LMTR", "severity": None, "details": {"message": "Engine oil pressure low"}}, "Missing required parameter severity"),
-        ({"source": "", "severity": "WARNING", "details": {"message": "Engine oil pressure low"}}, "Missing required parameter source"),
-        ({"source": None, "severity": "WARNING", "details": {"message": "Engine oil pressure low"}}, "Missing required parameter source"),
-        ({"source": "LMTR", "severity": "WARNING", "details": None}, "Missing required parameter details"),
+        ({"source": "LMTR", "severity": "", "details": {"message": "Engine oil pressure low"}}, "Missing required parameter(s): severity"),
+        ({"source": "LMTR", "severity": None, "details": {"message": "Engine oil pressure low"}}, "Missing required parameter(s): severity"),
+        ({"source": "", "severity": "WARNING", "details": {"message": "Engine oil pressure low"}}, "Missing required parameter(s): source"),
+        ({"source": None, "severity": "WARNING", "details": {"message": "Engine oil pressure low"}}, "Missing required parameter(s): source"),
+        ({"source": "LMTR", "severity": "WARNING", "details": None}, "Missing required parameter(s): details"),
+        ({"source": "", "severity": None, "details": None}, "Missing required parameter(s): severity, source, details"),
         ({"source": "LMTR", "severity": "WARNING", "details": ""}, "Details should be a valid json object"),
     ])
     async def test_create_audit_entry_with_bad_data(self, client, request_data, expected_response):
@@ -225,15 +408,16 @@ class TestAudit:
         assert 400 == resp.status
         assert expected_response == resp.reason
 
-    async def test_create_audit_entry_with_attribute_error(self, client):
+    async def test_create_audit_entry_with_bad_severity(self, client):
         request_data = {"source": "LMTR", "severity": "blah", "details": {"message": "Engine oil pressure low"}}
-        with patch.object(AuditLogger, "__init__", return_value=None):
+        with patch.object(AuditLogger, "__init__", return_value=None) as patch_init:
             resp = await client.post('/fledge/audit', data=json.dumps(request_data))
-            assert 404 == resp.status
+            assert 400 == resp.status
             assert 'severity type blah is not supported' == resp.reason
+        patch_init.assert_not_called()
 
     async def test_create_audit_entry_with_exception(self, client):
-        request_data = {"source": "LMTR", "severity": "blah", "details": {"message": "Engine oil pressure low"}}
+        request_data = {"source": "LMTR", "severity": "warning", "details": {"message": "Engine oil pressure low"}}
         with patch.object(AuditLogger, "__init__", return_value=""):
             with patch.object(audit._logger, 'error') as patch_logger:
                 resp = await client.post('/fledge/audit', data=json.dumps(request_data))